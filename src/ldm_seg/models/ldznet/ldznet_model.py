@@ -890,7 +890,7 @@ class LatentSeg(DDPM):
         ]
         prompt_indices = torch.multinomial(
             torch.ones(len(prompt_list)), len(words), replacement=True
-        )
+        ).tolist()
         prompts = [prompt_list[i] for i in prompt_indices]
         return [promt.format(w) for promt, w in zip(prompts, words)]
 
@@ -1,19 +1,88 @@
+import copy
+import inspect
+import os
+import warnings
 import torch
 import torch.nn as nn
-from functools import partial
+from collections import OrderedDict
+from functools import partial, lru_cache
 import clip
-from einops import rearrange, repeat
-from transformers import CLIPTokenizer, CLIPTextModel, T5Tokenizer, T5EncoderModel
+from einops import rearrange
+from transformers import CLIPTokenizerFast, CLIPTextModel, T5Tokenizer, T5EncoderModel
 import kornia
 
 from ldm_seg.modules.x_transformer import (
     Encoder,
     TransformerWrapper,
 )  # TODO: can we directly rely on lucidrains code and simply add this as a reuirement? --> test
-from omegaconf import OmegaConf
+from omegaconf import DictConfig, OmegaConf
 from ldm_seg.util import instantiate_from_config
 
 
+@lru_cache(maxsize=4)
+def get_tokenizer(tokenizer_cls, version):
+    # tokenizers are read-only, so instances loading the same vocab share one
+    return tokenizer_cls.from_pretrained(version)
+
+
+# padded input ids per (tokenizer, max_length, prompt), least recently used first
+_token_cache = OrderedDict()
+_token_cache_size = 8192
+
+
+def compile_forward(module, **kwargs):
+    # nn.Module.compile (torch >= 2.2) compiles in place, so state_dict keys stay
+    # unchanged and deepcopy/pickle still work
+    if hasattr(module, "compile"):
+        module.compile(**kwargs)
+    else:
+        warnings.warn(
+            f"torch {torch.__version__} has no nn.Module.compile (needs >= 2.2), "
+            f"running {module.__class__.__name__} uncompiled."
+        )
+    return module
+
+
+def get_dtype(dtype):
+    # configs pass dtypes by name, e.g. "bfloat16"
+    if isinstance(dtype, str):
+        return getattr(torch, dtype)
+    return dtype
+
+
+def pretrained_kwargs(torch_dtype=None, attn_implementation=None):
+    kwargs = {"torch_dtype": get_dtype(torch_dtype)}
+    # e.g. "sdpa" or "flash_attention_2"; left to the transformers default if unset
+    if attn_implementation is not None:
+        kwargs["attn_implementation"] = attn_implementation
+    return kwargs
+
+
+def tokenize(tokenizer, text, max_length):
+    if isinstance(text, str):
+        text = [text]
+    keys = [(tokenizer, max_length, t) for t in text]
+    misses = list(dict.fromkeys(k for k in keys if k not in _token_cache))
+    if len(misses) > 0:
+        # one batched call for everything not seen before
+        batch_encoding = tokenizer(
+            [k[-1] for k in misses],
+            truncation=True,
+            max_length=max_length,
+            return_overflowing_tokens=False,
+            padding="max_length",
+            return_tensors="pt",
+        )
+        for k, tokens in zip(misses, batch_encoding["input_ids"]):
+            _token_cache[k] = tokens.clone()
+    for k in keys:
+        _token_cache.move_to_end(k)
+    tokens = torch.stack([_token_cache[k] for k in keys])
+    while len(_token_cache) > _token_cache_size:
+        _token_cache.popitem(last=False)
+    return tokens
+
+
 class AbstractEncoder(nn.Module):
     def __init__(self):
         super().__init__()
@@ -32,8 +101,7 @@ class ClassEmbedder(nn.Module):
         if key is None:
             key = self.key
         # this is for use in crossattn
-        c = batch[key][:, None]
-        c = self.embedding(c)
+        c = self.embedding(batch[key].long()).unsqueeze(1)
         return c
 
 
@@ -65,22 +133,13 @@ class BERTTokenizer(AbstractEncoder):
         super().__init__()
         from transformers import BertTokenizerFast  # TODO: add to reuquirements
 
-        self.tokenizer = BertTokenizerFast.from_pretrained("bert-base-uncased")
+        self.tokenizer = get_tokenizer(BertTokenizerFast, "bert-base-uncased")
         self.device = device
         self.vq_interface = vq_interface
         self.max_length = max_length
 
     def forward(self, text):
-        batch_encoding = self.tokenizer(
-            text,
-            truncation=True,
-            max_length=self.max_length,
-            return_length=True,
-            return_overflowing_tokens=False,
-            padding="max_length",
-            return_tensors="pt",
-        )
-        tokens = batch_encoding["input_ids"].to(self.device)
+        tokens = tokenize(self.tokenizer, text, self.max_length).to(self.device)
         return tokens
 
     @torch.no_grad()
@@ -141,6 +200,8 @@ class SpatialRescaler(nn.Module):
         in_channels=3,
         out_channels=None,
         bias=False,
+        fuse_stages=False,
+        use_compile=False,
     ):
         super().__init__()
         self.n_stages = n_stages
@@ -153,7 +214,17 @@ class SpatialRescaler(nn.Module):
             "bicubic",
             "area",
         ]
+        self.method = method
         self.multiplier = multiplier
+        self.total_scale = multiplier**n_stages
+        # resizing once by multiplier**n_stages only approximates the staged
+        # resize in general, so it is opt-in; see can_fuse_stages for the cases
+        # where it is known to be identical
+        self.fuse_stages = fuse_stages
+        factor = multiplier if multiplier >= 1 else 1 / multiplier
+        self.power_of_two_factor = float(factor).is_integer() and (
+            int(factor) & (int(factor) - 1) == 0
+        )
         self.interpolator = partial(torch.nn.functional.interpolate, mode=method)
         self.remap_output = out_channels is not None
         if self.remap_output:
@@ -161,10 +232,58 @@ class SpatialRescaler(nn.Module):
                 f"Spatial Rescaler mapping from {in_channels} to {out_channels} channels after resizing."
             )
             self.channel_mapper = nn.Conv2d(in_channels, out_channels, 1, bias=bias)
+        # a nearest downsample by k followed by the 1x1 channel_mapper is the
+        # same 1x1 conv with stride k, see fused_downsample_and_remap. area is
+        # left to pool + conv, a dense k x k kernel would cost far more
+        self.fold_stride = None
+        if (
+            self.remap_output
+            and method == "nearest"
+            and self.total_scale < 1
+            and self.power_of_two_factor
+        ):
+            self.fold_stride = round(1 / self.total_scale)
+        if use_compile:
+            compile_forward(self)
+
+    def fused_downsample_and_remap(self, x):
+        return torch.nn.functional.conv2d(
+            x,
+            self.channel_mapper.weight,
+            bias=self.channel_mapper.bias,
+            stride=self.fold_stride,
+        )
+
+    def can_fuse_stages(self, x):
+        if self.fuse_stages:
+            return True
+        # with a power-of-two multiplier all scales and sizes are exact, so nearest
+        # samples the same pixels, and area averages the same windows as long as
+        # the input divides evenly
+        if self.n_stages == 0 or not self.power_of_two_factor:
+            return False
+        if self.method == "nearest":
+            return True
+        if self.method == "area" and self.total_scale < 1:
+            k = round(1 / self.total_scale)
+            return all(s % k == 0 for s in x.shape[2:])
+        return False
 
     def forward(self, x):
-        for stage in range(self.n_stages):
-            x = self.interpolator(x, scale_factor=self.multiplier)
+        if (
+            self.fold_stride is not None
+            and x.ndim == 4
+            and x.shape[-2] % self.fold_stride == 0
+            and x.shape[-1] % self.fold_stride == 0
+        ):
+            return self.fused_downsample_and_remap(x)
+
+        if self.can_fuse_stages(x):
+            if self.n_stages > 0:
+                x = self.interpolator(x, scale_factor=self.total_scale)
+        else:
+            for stage in range(self.n_stages):
+                x = self.interpolator(x, scale_factor=self.multiplier)
 
         if self.remap_output:
             x = self.channel_mapper(x)
@@ -174,72 +293,125 @@ class SpatialRescaler(nn.Module):
         return self(x)
 
 
-class FrozenCLIPEmbedder(AbstractEncoder):
-    """Uses the CLIP transformer encoder for text (from Hugging Face)"""
+class FrozenTextEmbedder(AbstractEncoder):
+    """Base class for frozen text encoders; can memoize the output per prompt"""
 
-    def __init__(
-        self, version="openai/clip-vit-large-patch14", device="cuda", max_length=77
-    ):
+    def __init__(self, cache_size=0, use_compile=False):
         super().__init__()
-        self.tokenizer = CLIPTokenizer.from_pretrained(version)
-        self.transformer = CLIPTextModel.from_pretrained(version)
-        self.device = device
-        self.max_length = max_length
-        self.freeze()
+        self.cache_size = cache_size
+        self.use_compile = use_compile
+        self._cache = OrderedDict()
+        # cached outputs are stale once new weights are loaded
+        self._register_load_state_dict_pre_hook(self.clear_cache)
+
+    def clear_cache(self, *args, **kwargs):
+        self._cache.clear()
+
+    def _apply(self, fn, *args, **kwargs):
+        # entries live next to the weights, so drop them on .to() / .half() etc.
+        self.clear_cache()
+        return super()._apply(fn, *args, **kwargs)
 
     def freeze(self):
         self.transformer = self.transformer.eval()
         for param in self.parameters():
             param.requires_grad = False
+        if self.use_compile:
+            # inputs are padded to max_length, so shapes are static
+            compile_forward(self.transformer, mode="reduce-overhead", dynamic=False)
 
-    def forward(self, text):
-        batch_encoding = self.tokenizer(
-            text,
-            truncation=True,
-            max_length=self.max_length,
-            return_length=True,
-            return_overflowing_tokens=False,
-            padding="max_length",
-            return_tensors="pt",
-        )
-        tokens = batch_encoding["input_ids"].to(self.device)
-        outputs = self.transformer(input_ids=tokens)
+    def embed(self, text):
+        raise NotImplementedError
 
-        z = outputs.last_hidden_state
+    @torch.no_grad()
+    def forward(self, text):
+        if isinstance(text, str):
+            text = [text]
+        if self.cache_size <= 0:
+            return self.embed(text)
+
+        misses = list(dict.fromkeys(t for t in text if t not in self._cache))
+        if len(misses) > 0:
+            # clone the rows so an entry does not keep its whole batch alive
+            for t, z in zip(misses, self.embed(misses)):
+                self._cache[t] = z.clone()
+        for t in text:
+            self._cache.move_to_end(t)
+        z = torch.stack([self._cache[t] for t in text])
+        while len(self._cache) > self.cache_size:
+            self._cache.popitem(last=False)
         return z
 
     def encode(self, text):
         return self(text)
 
 
-class FrozenT5Embedder(AbstractEncoder):
-    """Uses the T5-XXL transformer encoder for text (from Hugging Face)"""
+class FrozenCLIPEmbedder(FrozenTextEmbedder):
+    """Uses the CLIP transformer encoder for text (from Hugging Face)"""
 
-    def __init__(self, device="cuda", max_length=77):
-        super().__init__()
-        self.tokenizer = T5Tokenizer.from_pretrained("google/t5-v1_1-xl")
-        self.transformer = T5EncoderModel.from_pretrained("google/t5-v1_1-xl")
+    def __init__(
+        self,
+        version="openai/clip-vit-large-patch14",
+        device="cuda",
+        max_length=77,
+        cache_size=0,
+        use_compile=False,
+        torch_dtype=None,
+        attn_implementation=None,
+    ):
+        super().__init__(cache_size=cache_size, use_compile=use_compile)
+        self.tokenizer = get_tokenizer(CLIPTokenizerFast, version)
+        self.transformer = CLIPTextModel.from_pretrained(
+            version, **pretrained_kwargs(torch_dtype, attn_implementation)
+        )
         self.device = device
         self.max_length = max_length
         self.freeze()
 
-    def freeze(self):
-        self.transformer = self.transformer.eval()
-        for param in self.parameters():
-            param.requires_grad = False
-
-    def forward(self, text):
-        with torch.no_grad():
-            # batch_encoding = self.tokenizer(text, truncation=True, max_length=self.max_length, return_length=True, return_overflowing_tokens=False, padding="max_length", return_tensors="pt")
-            batch_encoding = self.tokenizer(text, return_tensors="pt")
-            tokens = batch_encoding["input_ids"].to(self.device)
-            outputs = self.transformer(input_ids=tokens)
+    def embed(self, text):
+        tokens = tokenize(self.tokenizer, text, self.max_length).to(self.device)
+        outputs = self.transformer(input_ids=tokens)
 
-            z = outputs.last_hidden_state
+        z = outputs.last_hidden_state.float()
+        if self.use_compile:
+            # cuda graphs reuse their output buffer on the next call
+            z = z.clone()
         return z
 
-    def encode(self, text):
-        return self(text)
+
+class FrozenT5Embedder(FrozenTextEmbedder):
+    """Uses the T5-XXL transformer encoder for text (from Hugging Face)"""
+
+    def __init__(
+        self,
+        device="cuda",
+        max_length=77,
+        cache_size=0,
+        use_compile=False,
+        torch_dtype="bfloat16",
+        attn_implementation=None,
+    ):
+        super().__init__(cache_size=cache_size, use_compile=use_compile)
+        self.tokenizer = get_tokenizer(T5Tokenizer, "google/t5-v1_1-xl")
+        # frozen weights are only read, so keep them in half precision
+        self.transformer = T5EncoderModel.from_pretrained(
+            "google/t5-v1_1-xl", **pretrained_kwargs(torch_dtype, attn_implementation)
+        )
+        self.device = device
+        self.max_length = max_length
+        self.freeze()
+
+    def embed(self, text):
+        tokens = tokenize(self.tokenizer, text, self.max_length).to(self.device)
+        # T5 attends bidirectionally, so padding has to be masked out
+        attention_mask = (tokens != self.tokenizer.pad_token_id).long()
+        outputs = self.transformer(input_ids=tokens, attention_mask=attention_mask)
+
+        z = outputs.last_hidden_state.float()
+        if self.use_compile:
+            # cuda graphs reuse their output buffer on the next call
+            z = z.clone()
+        return z
 
 
 class FrozenCLIPTextEmbedder(nn.Module):
@@ -271,14 +443,16 @@ class FrozenCLIPTextEmbedder(nn.Module):
         tokens = clip.tokenize(text).to(self.device)
         z = self.model.encode_text(tokens)
         if self.normalize:
-            z = z / torch.linalg.norm(z, dim=1, keepdim=True)
+            # in fp32, as the eps clamp underflows to 0 for the fp16 cuda model
+            z = torch.nn.functional.normalize(z.float(), dim=1).to(z.dtype)
         return z
 
     def encode(self, text):
         z = self(text)
         if z.ndim == 2:
             z = z[:, None, :]
-        z = repeat(z, "b 1 d -> b k d", k=self.n_repeat)
+        # stride-0 view instead of n_repeat copies, consumers only read it
+        z = z.expand(-1, self.n_repeat, -1)
         return z
 
 
@@ -293,11 +467,15 @@ class FrozenClipImageEmbedder(nn.Module):
         jit=False,
         device="cuda" if torch.cuda.is_available() else "cpu",
         antialias=False,
+        channels_last=False,
     ):
         super().__init__()
         self.model, _ = clip.load(name=model, device=device, jit=jit)
 
         self.antialias = antialias
+        self.channels_last = channels_last
+        if self.channels_last:
+            self.model.visual = self.model.visual.to(memory_format=torch.channels_last)
 
         self.register_buffer(
             "mean", torch.Tensor([0.48145466, 0.4578275, 0.40821073]), persistent=False
@@ -305,24 +483,37 @@ class FrozenClipImageEmbedder(nn.Module):
         self.register_buffer(
             "std", torch.Tensor([0.26862954, 0.26130258, 0.27577711]), persistent=False
         )
+        # (x + 1) / 2 followed by (x - mean) / std, folded into x * scale + shift
+        self.register_buffer(
+            "scale", (0.5 / self.std).view(1, 3, 1, 1), persistent=False
+        )
+        self.register_buffer(
+            "shift", ((0.5 - self.mean) / self.std).view(1, 3, 1, 1), persistent=False
+        )
 
     def preprocess(self, x):
-        # normalize to [0,1]
-        x = kornia.geometry.resize(
-            x,
-            (224, 224),
-            interpolation="bicubic",
-            align_corners=True,
-            antialias=self.antialias,
-        )
-        x = (x + 1.0) / 2.0
-        # renormalize according to clip
-        x = kornia.enhance.normalize(x, self.mean, self.std)
-        return x
+        if self.antialias:
+            x = kornia.geometry.resize(
+                x,
+                (224, 224),
+                interpolation="bicubic",
+                align_corners=True,
+                antialias=True,
+            )
+        else:
+            # this is what kornia's resize reduces to without antialiasing
+            x = torch.nn.functional.interpolate(
+                x, (224, 224), mode="bicubic", align_corners=True
+            )
+        # normalize to [0,1] and renormalize according to clip in one pass
+        return torch.addcmul(self.shift, x, self.scale)
 
     def forward(self, x):
         # x is assumed to be in range [-1,1]
-        return self.model.encode_image(self.preprocess(x))
+        x = self.preprocess(x)
+        if self.channels_last:
+            x = x.contiguous(memory_format=torch.channels_last)
+        return self.model.encode_image(x)
 
 
 class FrozenSDUNet(AbstractEncoder):
@@ -333,23 +524,55 @@ class FrozenSDUNet(AbstractEncoder):
         path="models/ldm/stable-diffusion-v1/sd-v1-4-full-ema.ckpt",
         config=None,
         timesteps=None,
+        use_compile=False,
+        channels_last=False,
+        verbose=False,
     ):
         super().__init__()
-        self.config = OmegaConf.load(f"{config}")
+        # a config that is already loaded is used as is, e.g. when every DDP
+        # process builds its own instance
+        if isinstance(config, DictConfig):
+            self.config = config
+        else:
+            self.config = OmegaConf.load(f"{config}")
         self.ckpt_path = path
         self.timesteps = timesteps
-        self.model = self.load_model_from_config()
+        self.use_compile = use_compile
+        self.channels_last = channels_last
+        # scratch buffers for noise and timesteps, reused across forwards
+        self._noise = None
+        self._t = None
+        self.model = self.load_model_from_config(verbose=verbose)
         del self.model.first_stage_model, self.model.cond_stage_model
         self.freeze()
 
+    def load_checkpoint(self, ckpt):
+        # prefer a .safetensors sibling, otherwise memory-map the pickle so the
+        # weights are not held twice in host memory while loading
+        safetensors_path = os.path.splitext(ckpt)[0] + ".safetensors"
+        if os.path.exists(safetensors_path):
+            from safetensors.torch import load_file
+
+            return {"state_dict": load_file(safetensors_path, device="cpu")}
+        if "mmap" in inspect.signature(torch.load).parameters:
+            return torch.load(ckpt, map_location="cpu", mmap=True)
+        return torch.load(ckpt, map_location="cpu")
+
     def load_model_from_config(self, verbose=False):
         config = self.config
         ckpt = self.ckpt_path
-        print(f"Loading model from {ckpt}")
-        pl_sd = torch.load(ckpt, map_location="cpu")
-        if "global_step" in pl_sd:
+        if verbose:
+            print(f"Loading model from {ckpt}")
+        pl_sd = self.load_checkpoint(ckpt)
+        if "global_step" in pl_sd and verbose:
             print(f"Global Step: {pl_sd['global_step']}")
-        sd = pl_sd["state_dict"]
+        # the autoencoder and text encoder are deleted right after loading, so
+        # neither build them nor load their weights
+        skipped = ("first_stage_model.", "cond_stage_model.")
+        sd = {k: v for k, v in pl_sd["state_dict"].items() if not k.startswith(skipped)}
+        config = copy.deepcopy(config)
+        config.model.params.first_stage_config = {"target": "torch.nn.Identity"}
+        config.model.params.cond_stage_config = {"target": "torch.nn.Identity"}
         model = instantiate_from_config(config.model)
         m, u = model.load_state_dict(sd, strict=False)
         if len(m) > 0 and verbose:
@@ -364,26 +587,54 @@ class FrozenSDUNet(AbstractEncoder):
 
     def freeze(self):
         self.model = self.model.eval()
+        if self.model.use_ema:
+            # the weights never change after loading, so swap in the EMA weights
+            # once instead of entering ema_scope on every forward. LitEma only
+            # copies parameters that still require grad, so do it before freezing
+            self.model.model_ema.copy_to(self.model.model)
+            self.model.use_ema = False
         for param in self.parameters():
             param.requires_grad = False
+        if self.channels_last:
+            # NHWC weights make the convolutions (and their outputs) channels_last
+            self.model.model.diffusion_model = self.model.model.diffusion_model.to(
+                memory_format=torch.channels_last
+            )
+        if self.use_compile:
+            # only the unet is compiled, q_sample stays in eager mode
+            compile_forward(
+                self.model.model.diffusion_model, mode="reduce-overhead", dynamic=False
+            )
+
+    def sample_noise_and_timesteps(self, z, timestep=None):
+        b = z.shape[0]
+        if (
+            self._noise is None
+            or self._noise.shape[0] < b
+            or self._noise.shape[1:] != z.shape[1:]
+            or self._noise.dtype != z.dtype
+            or self._noise.device != z.device
+        ):
+            self._noise = torch.empty_like(z)
+            self._t = torch.empty(b, dtype=torch.long, device=z.device)
+        # same draws, in the same order, from the global RNG as torch.randint
+        # followed by torch.randn_like
+        t = self._t[:b]
+        if timestep is None:
+            t.random_(self.timesteps[0], self.timesteps[-1])
+        else:
+            t.random_(timestep, timestep + 1)
+        noise = self._noise[:b].normal_()
+        return noise, t
 
     def forward(self, z, c, timestep=None):
-        with self.model.ema_scope():
-            if timestep is None:
-                t = torch.randint(
-                    self.timesteps[0],
-                    self.timesteps[-1],
-                    (z.shape[0],),
-                    device=z.device,
-                ).long()
-            else:
-                t = torch.randint(
-                    timestep, timestep + 1, (z.shape[0],), device=z.device
-                ).long()
-            noise = torch.randn_like(z)
-            z_noisy = self.model.q_sample(x_start=z, t=t, noise=noise)
-            z_recon, all_features = self.model.apply_model(z_noisy, t, c)
-            return all_features
+        noise, t = self.sample_noise_and_timesteps(z, timestep=timestep)
+        z_noisy = self.model.q_sample(x_start=z, t=t, noise=noise)
+        z_recon, all_features = self.model.apply_model(z_noisy, t, c)
+        if self.use_compile:
+            # cuda graphs reuse their output buffers on the next call
+            all_features = [f.clone() for f in all_features]
+        return all_features
         # with self.model.ema_scope():
         #     noise = torch.randn_like(z)
         #     features = {}